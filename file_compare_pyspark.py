@@ -1,26 +1,71 @@
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession, functions as F
+from pyspark.sql.types import StructType, StructField, StringType, IntegerType, LongType, DoubleType
 from pyspark.sql.window import Window
 from datetime import datetime
-import os, re, html
+import os, re, html, csv, json, shutil
 
 csv_path = os.path.join(os.getcwd(), "racing_sample_1000rows_500sensors.csv")
 sep = ","  # change to '|' if needed
+parquet_path = os.path.splitext(csv_path)[0] + ".parquet"  # columnar copy the checks run against
 out_dir = os.path.join(os.getcwd(), "dq_report")
-os.makedirs(out_dir, exist_ok=True)
+viol_dir = os.path.join(out_dir, "violations")
+os.makedirs(viol_dir, exist_ok=True)
+pk = ["event_id","session","car_no","lap"]  # identifies a row; kept in every violation export
+single_file_max_rows = 100_000  # larger violation sets are written as multiple part files
+
+# known column types; sensor_*_val / sensor_*_flag are typed by suffix, anything else stays a string
+col_types = {
+    "lap": LongType(), "car_no": LongType(),
+    "timestamp_ms": DoubleType(),  # the file writes these in scientific notation (1.725E+12)
+    "grid_position": IntegerType(), "pitstops_so_far": IntegerType(), "drs_enabled": IntegerType(),
+    "air_temp_c": DoubleType(), "track_temp_c": DoubleType(), "fuel_kg": DoubleType(),
+    "battery_soc": DoubleType(), "ers_deploy": DoubleType(),
+}
+
+_WS = re.compile(r"\s+")
+
+def clean_name(c):
+    return _WS.sub("_", c.replace("\ufeff", "").strip())
 
 def clean_cols(df):
-    names = []
-    for c in df.columns:
-        n = c.replace("\ufeff", "").strip()
-        n = re.sub(r"\s+", "_", n)
-        names.append(n)
-    return df.toDF(*names)
+    names = [clean_name(c) for c in df.columns]
+    return df if names == df.columns else df.toDF(*names)
+
+def csv_schema(path, sep):
+    # explicit schema from the header line only, so the reader skips the inferSchema pass
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        header = next(csv.reader(f, delimiter=sep, quotechar='"'))
+    fields = []
+    for c in header:
+        n = clean_name(c)
+        if n in col_types:
+            t = col_types[n]
+        elif n.startswith("sensor_") and n.endswith("_val"):
+            t = DoubleType()
+        elif n.startswith("sensor_") and n.endswith("_flag"):
+            t = IntegerType()
+        else:
+            t = StringType()
+        fields.append(StructField(n, t, True))
+    return StructType(fields)
+
+def parquet_is_current(path, source):
+    # reuse the copy only if a build committed (_SUCCESS) from this exact CSV and reader settings
+    meta = os.path.join(path, "_dq_source.json")
+    if not (os.path.exists(os.path.join(path, "_SUCCESS")) and os.path.exists(meta)):
+        return False
+    with open(meta, encoding="utf-8") as f:
+        return json.load(f) == source
 
 def sample_rows(df, cols, n=20):
     cols = [c for c in cols if c in df.columns]
     if not cols or df is None:
         return []
-    return [r.asDict() for r in df.select(*cols).limit(n).collect()]
+    return [r.asDict() for r in df.select(*cols).take(n)]
+
+def _cell(v):
+    return "" if v is None else html.escape(str(v))
 
 def html_table(rows, cols):
     if not rows:
@@ -28,39 +73,50 @@ def html_table(rows, cols):
     if not cols:
         cols = list({k for r in rows for k in r.keys()})
     head = "".join(f"<th>{html.escape(c)}</th>" for c in cols)
-    body = []
-    for r in rows:
-        def _safe_str(v):
-            return "" if v is None else str(v)
-
-        tds = "".join(
-            f"<td>{html.escape(_safe_str(r.get(c)))}</td>"
-            for c in cols
-        )
-        body.append(f"<tr>{tds}</tr>")
-    return f"<table class='mini'><thead><tr>{head}</tr></thead><tbody>{''.join(body)}</tbody></table>"
-
-def write_violations(df, name):
+    body = "".join(
+        "<tr>" + "".join(f"<td>{_cell(r.get(c))}</td>" for c in cols) + "</tr>"
+        for r in rows
+    )
+    return f"<table class='mini'><thead><tr>{head}</tr></thead><tbody>{body}</tbody></table>"
+
+def write_violations(df, name, cols=None, count=None):
     if df is None:
         return None
-    df_count = df.count()
-    if df_count == 0:
-        return None
-    dest = os.path.join(out_dir, "violations", name)
-    (df.coalesce(1)
-       .write.mode("overwrite")
+    cols = [c for c in dict.fromkeys(pk + (cols or [])) if c in df.columns]
+    if cols:
+        df = df.select(*cols)
+    # one file is convenient for small outputs, but coalesce(1) would make the whole
+    # upstream stage single-task for big ones, so those keep Spark's own partitioning
+    if count is not None and count <= single_file_max_rows:
+        df = df.coalesce(1)
+    dest = os.path.join(viol_dir, name)
+    (df.write.mode("overwrite")
        .option("header", True)
        .csv(dest))
     return dest
 
-def add_result(results, name, df_count, sample_cols=None, note=""):
+def flag_counts(df, checks):
+    # one job for all row-level rules: a conditional count per rule in a single agg
+    row = df.agg(*[F.count(F.when(p, 1)).alias(n) for n, p in checks.items()]).collect()[0]
+    return {n: row[n] for n in checks}
+
+def by_cardinality(df, cols):
+    # highest-cardinality key first makes the window sort compare fewer tied prefixes
+    card = df.agg(*[F.approx_count_distinct(c).alias(c) for c in cols]).collect()[0]
+    return sorted(cols, key=lambda c: card[c], reverse=True)
+
+def add_result(results, name, df_count, sample_cols=None, note="", count=None):
+    samp_rows, csv_path = [], None
     if hasattr(df_count, "count"):
-        count = df_count.count()
-        samp_rows = sample_rows(df_count, sample_cols or [])
-        csv_path = write_violations(df_count, name)
+        count = df_count.count() if count is None else count
+        if count:
+            # sample and export both read the same violation rows; compute them once
+            df_count.cache()
+            samp_rows = sample_rows(df_count, sample_cols or [])
+            csv_path = write_violations(df_count, name, sample_cols, count)
+            df_count.unpersist()
     else:
         count = int(df_count)
-        samp_rows, csv_path = [], None
     results.append({
         "name": name,
         "violations": count,
@@ -75,19 +131,111 @@ def add_result(results, name, df_count, sample_cols=None, note=""):
 spark = (SparkSession.builder
          .appName("racing_dq")
          .master("local[*]")
+         .config("spark.sql.adaptive.enabled", "true")
+         .config("spark.sql.adaptive.coalescePartitions.enabled", "true")
+         .config("spark.shuffle.compress", "true")
+         .config("spark.shuffle.spill.compress", "true")
+         .config("spark.serializer", "org.apache.spark.serializer.KryoSerializer")
+         # the default 200 shuffle partitions is pure task overhead for a local run this size
+         .config("spark.sql.shuffle.partitions", str((os.cpu_count() or 1) * 2))
          .getOrCreate())
+spark.conf.set("spark.sql.inMemoryColumnarStorage.compressed", "true")
 
-df = (spark.read
-      .option("header", True)
-      .option("inferSchema", True)
-      .option("sep", sep)
-      .option("quote", '"').option("escape", '"')
-      .csv(csv_path))
+# convert the CSV to Parquet once so later runs get column pruning and predicate pushdown
+schema = csv_schema(csv_path, sep)
+source = {"csv": csv_path, "mtime": os.path.getmtime(csv_path), "size": os.path.getsize(csv_path),
+          "sep": sep, "schema": schema.json()}
+if not parquet_is_current(parquet_path, source):
+    # build beside the live copy and swap it in, so a failed run never leaves a half-written copy
+    tmp_path = parquet_path + ".tmp"
+    raw = (spark.read
+           .option("header", True)
+           .schema(schema)
+           .option("sep", sep)
+           .option("quote", '"').option("escape", '"')
+           .csv(csv_path))
+    raw = clean_cols(raw)
+    writer = raw.write.mode("overwrite")
+    if "event_id" in raw.columns:
+        writer = writer.partitionBy("event_id")
+    writer.parquet(tmp_path)
+    with open(os.path.join(tmp_path, "_dq_source.json"), "w", encoding="utf-8") as f:
+        json.dump(source, f)
+    shutil.rmtree(parquet_path, ignore_errors=True)
+    os.rename(tmp_path, parquet_path)
 
-df = clean_cols(df)
-total_rows = df.count()
+# read back with the CSV schema: otherwise event_id's type is re-inferred from the partition
+# directory names (an ID like 0012 becomes 12) and the column moves to the end
+df = spark.read.schema(schema).parquet(parquet_path).select(*schema.fieldNames())
 
 # ---- checks ----
+need = ["event_id","session","car_no","lap","timestamp_ms"]
+
+# row-level rules: name -> (predicate, sample_cols, note), counted together in one pass.
+# sample_cols must cover every column the predicate reads (other than the probes below).
+rules = {}
+# 13 digits == [10^12, 10^13) as a number; two comparisons instead of a per-row regex
+rules["timestamp_ms_is_13_digits"] = (
+    F.col("timestamp_ms").isNull() |
+    (F.col("timestamp_ms").cast("long") < F.lit(10**12)) |
+    (F.col("timestamp_ms").cast("long") >= F.lit(10**13)),
+    ["event_id","lap","timestamp_ms"], "")
+rules["air_temp_c_in_0_30"] = (
+    F.col("_a").isNull() | (F.col("_a") < 0) | (F.col("_a") > 30),
+    ["event_id","lap","air_temp_c"], "")
+rules["track_temp_c_in_-20_80"] = (
+    F.col("_t").isNull() | (F.col("_t") < -20) | (F.col("_t") > 80),
+    ["event_id","lap","track_temp_c"], "")
+rules["battery_soc_in_0.6_40"] = (
+    F.col("_s").isNull() | (F.col("_s") < 0.6) | (F.col("_s") > 40),
+    ["event_id","lap","battery_soc"], "")
+rules["fuel_kg_non_negative"] = (
+    F.col("_f").isNull() | (F.col("_f") < 0),
+    ["event_id","lap","fuel_kg"], "")
+
+# conditional example: wet -> sensor_0008_val in [100,250]
+if "tyre" in df.columns and "sensor_0008_val" in df.columns:
+    is_wet = F.trim(F.col("_tyre_lower")) == F.lit("wet")
+    v8 = F.col("sensor_0008_val").cast("double")
+    rules["if_wet_then_sensor_0008_val_100_250"] = (
+        is_wet & (v8.isNull() | ~v8.between(100.0, 250.0)),
+        ["event_id","lap","tyre","sensor_0008_val"], "")
+
+# tyre domain
+allowed = ["Soft","Medium","Hard","Wet","Intermediate"]
+allowed_lower = [t.lower() for t in allowed]
+if "tyre" in df.columns:
+    # a 5-value isin stays inside the fused pass; an anti-join would need its own job
+    rules["tyre_in_domain"] = (
+        ~F.col("_tyre_lower").isin(allowed_lower),
+        ["event_id","lap","tyre"], f"Allowed: {allowed}")
+
+# every check re-reads the same rows: cache them once, but only the columns the checks read,
+# so the Parquet scan is pruned to those and the ~1000-column frame is never materialised
+check_cols = [c for c in dict.fromkeys([c for r in rules.values() for c in r[1]] + need)
+              if c in df.columns]
+checked = df.select(*check_cols).persist(StorageLevel.MEMORY_AND_DISK)
+total_rows = checked.count()
+
+# probes are computed once up front (numeric casts, lower-cased tyre) and the rules read them.
+probes = {a: F.col(c).cast("double") for a, c in
+          {"_a": "air_temp_c", "_t": "track_temp_c", "_s": "battery_soc", "_f": "fuel_kg"}.items()}
+if "tyre" in df.columns:
+    probes["_tyre_lower"] = F.lower(F.col("tyre"))
+dfx = checked.select("*", *[e.alias(a) for a, e in probes.items()])
+
+rule_counts = flag_counts(dfx, {n: r[0] for n, r in rules.items()})
+
+def add_rule(results, name, missing_note=""):
+    if name not in rules:
+        add_result(results, name, 1, note=missing_note)
+        return
+    pred, cols, note = rules[name]
+    n = rule_counts[name]
+    # clean rules never build a filtered frame, so no sample/write jobs run for them
+    bad = dfx.filter(pred).drop(*probes) if n else 0
+    add_result(results, name, bad, sample_cols=cols, note=note, count=n)
+
 results = []
 
 # required columns
@@ -96,74 +244,59 @@ missing = [c for c in required if c not in df.columns]
 add_result(results, "required_columns_present", 0 if not missing else 1,
            note=("All present" if not missing else f"Missing: {', '.join(missing)}"))
 
-# pk uniqueness
-pk = ["event_id","session","car_no","lap"]
-if all(c in df.columns for c in pk):
-    dupes = df.groupBy(*pk).count().filter(F.col("count") > 1)
-    add_result(results, "pk_unique", dupes, sample_cols=pk+["count"])
+# pk uniqueness + per-car ordering share one shuffle: rows hash-partitioned on the car keys
+# are already clustered for the (car keys + lap) pk window, so both windows run on one exchange
+has_pk = all(c in df.columns for c in pk)
+has_seq = all(c in df.columns for c in need)
+if has_pk:
+    car_keys = by_cardinality(checked, ["event_id","session","car_no"])
+    # hash-distribute on the window keys up front so the per-car sorts run in parallel tasks
+    d2 = (checked.select(*[c for c in need if c in df.columns])
+            .repartition(spark.sparkContext.defaultParallelism, *car_keys))
+    seq_preds = {}
+    if has_seq:
+        # for each car, does the timestamp go backward as the laps increase
+        w = Window.partitionBy(*car_keys).orderBy(F.col("lap").cast("long"))
+        d2 = (d2.withColumn("lap_long", F.col("lap").cast("long"))
+                .withColumn("ts_long",  F.col("timestamp_ms").cast("long"))
+                .withColumn("prev_lap", F.lag("lap_long").over(w))
+                .withColumn("prev_ts",  F.lag("ts_long").over(w)))
+        seq_preds["lap"] = F.col("prev_lap").isNotNull() & (F.col("lap_long") < F.col("prev_lap"))
+        seq_preds["ts"]  = F.col("prev_ts").isNotNull()  & (F.col("ts_long")  < F.col("prev_ts"))
+    d2 = d2.withColumn("pk_count", F.count(F.lit(1)).over(Window.partitionBy(*car_keys, "lap")))
+    seq_preds["pk"] = F.col("pk_count") > 1
+    # sort once, cache, and derive every windowed check from it
+    d2 = d2.cache()
+    seq_counts = flag_counts(d2, seq_preds)
+    add_result(results, "pk_unique", d2.filter(seq_preds["pk"]),
+               sample_cols=pk+["pk_count"], count=seq_counts["pk"])
 else:
     add_result(results, "pk_unique", 1, note=f"Missing PK cols: {set(pk) - set(df.columns)}")
 
 # timestamp format (13 digits)
-bad_ts = df.filter(F.col("timestamp_ms").isNull() |
-                   ~F.col("timestamp_ms").cast("string").rlike(r"^\d{13}$"))
-add_result(results, "timestamp_ms_is_13_digits", bad_ts,
-           sample_cols=["event_id","lap","timestamp_ms"])
+add_rule(results, "timestamp_ms_is_13_digits")
 
-# for each car, does the timestamp go backward as the laps increase
-need = ["event_id","session","car_no","lap","timestamp_ms"]
-if all(c in df.columns for c in need):
-    w = Window.partitionBy("event_id","session","car_no").orderBy(F.col("lap").cast("long"))
-    d2 = (df.withColumn("lap_long", F.col("lap").cast("long"))
-            .withColumn("ts_long",  F.col("timestamp_ms").cast("long"))
-            .withColumn("prev_lap", F.lag("lap_long").over(w))
-            .withColumn("prev_ts",  F.lag("ts_long").over(w)))
-    lap_back = d2.filter(F.col("prev_lap").isNotNull() & (F.col("lap_long") < F.col("prev_lap")))
-    ts_back  = d2.filter(F.col("prev_ts").isNotNull()  & (F.col("ts_long")  < F.col("prev_ts")))
-    add_result(results, "lap_not_decreasing_per_car", lap_back,
-               sample_cols=["event_id","session","car_no","prev_lap","lap"])
-    add_result(results, "timestamp_not_decreasing_per_car", ts_back,
-               sample_cols=["event_id","session","car_no","prev_ts","timestamp_ms"])
+if has_seq:
+    add_result(results, "lap_not_decreasing_per_car", d2.filter(seq_preds["lap"]),
+               sample_cols=["event_id","session","car_no","prev_lap","lap"],
+               count=seq_counts["lap"])
+    add_result(results, "timestamp_not_decreasing_per_car", d2.filter(seq_preds["ts"]),
+               sample_cols=["event_id","session","car_no","prev_ts","timestamp_ms"],
+               count=seq_counts["ts"])
 else:
     add_result(results, "lap_not_decreasing_per_car", 1, note="missing columns")
     add_result(results, "timestamp_not_decreasing_per_car", 1, note="missing columns")
+if has_pk:
+    d2.unpersist()
 
 # verify data ranges
-bad_air   = df.filter( F.col("air_temp_c").cast("double").isNull() |
-                      (F.col("air_temp_c").cast("double") < 0) |
-                      (F.col("air_temp_c").cast("double") > 30) )
-bad_track = df.filter( F.col("track_temp_c").cast("double").isNull() |
-                      (F.col("track_temp_c").cast("double") < -20) |
-                      (F.col("track_temp_c").cast("double") > 80) )
-bad_soc   = df.filter( F.col("battery_soc").cast("double").isNull() |
-                      (F.col("battery_soc").cast("double") < 0.6) |
-                      (F.col("battery_soc").cast("double") > 40) )
-bad_fuel  = df.filter( F.col("fuel_kg").cast("double").isNull() |
-                      (F.col("fuel_kg").cast("double") < 0) )
-
-add_result(results, "air_temp_c_in_0_30", bad_air,   sample_cols=["event_id","lap","air_temp_c"])
-add_result(results, "track_temp_c_in_-20_80", bad_track, sample_cols=["event_id","lap","track_temp_c"])
-add_result(results, "battery_soc_in_0.6_40", bad_soc, sample_cols=["event_id","lap","battery_soc"])
-add_result(results, "fuel_kg_non_negative", bad_fuel, sample_cols=["event_id","lap","fuel_kg"])
-
-# conditional example: wet -> sensor_0008_val in [100,250]
-if "tyre" in df.columns and "sensor_0008_val" in df.columns:
-    is_wet = F.lower(F.trim(F.col("tyre"))) == F.lit("wet")
-    v8 = F.col("sensor_0008_val").cast("double")
-    bad_wet = df.filter(is_wet & (v8.isNull() | ~v8.between(100.0, 250.0)))
-    add_result(results, "if_wet_then_sensor_0008_val_100_250",
-               bad_wet, sample_cols=["event_id","lap","tyre","sensor_0008_val"])
-else:
-    add_result(results, "if_wet_then_sensor_0008_val_100_250", 1, note="missing tyre or sensor_0008_val")
-
-# tyre domain
-if "tyre" in df.columns:
-    allowed = ["Soft","Medium","Hard","Wet","Intermediate"]
-    bad_tyre = df.filter(~F.lower("tyre").isin([t.lower() for t in allowed]))
-    add_result(results, "tyre_in_domain", bad_tyre, sample_cols=["event_id","lap","tyre"],
-               note=f"Allowed: {allowed}")
-else:
-    add_result(results, "tyre_in_domain", 1, note="missing tyre")
+add_rule(results, "air_temp_c_in_0_30")
+add_rule(results, "track_temp_c_in_-20_80")
+add_rule(results, "battery_soc_in_0.6_40")
+add_rule(results, "fuel_kg_non_negative")
+# conditional + domain rules
+add_rule(results, "if_wet_then_sensor_0008_val_100_250", missing_note="missing tyre or sensor_0008_val")
+add_rule(results, "tyre_in_domain", missing_note="missing tyre")
 
 # ---- HTML ----
 summary_rows = []
@@ -228,5 +361,7 @@ html_out = f"""<!doctype html>
 with open(os.path.join(out_dir, "dq_report.html"), "w", encoding="utf-8") as f:
     f.write(html_out)
 
+checked.unpersist()
+
 print(f"Report: {os.path.join(out_dir, 'dq_report.html')}")
-print(f"Violations (if any): {os.path.join(out_dir, 'violations')}")
+print(f"Violations (if any): {viol_dir}")